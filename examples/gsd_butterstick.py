@@ -24,6 +24,7 @@ from litex_boards.platforms import butterstick
 from litex.build.lattice.trellis import trellis_args, trellis_argdict
 
 from litex.soc.cores.clock import *
+from litex.soc.integration.soc import SoCRegion
 from litex.soc.integration.soc_core import *
 from litex.soc.integration.builder import *
 from litex.soc.cores.led import LedChaser
@@ -92,6 +93,8 @@ class BaseSoC(SoCCore):
         local_ip="", remote_ip="",
         with_spi_flash=False,
         with_led_chaser=True,
+        with_pdm_pipeline=False,
+        with_pdm_stereo=False,
         **kwargs)       :
         platform = butterstick.Platform(revision=revision, device=device ,toolchain=toolchain)
 
@@ -165,7 +168,11 @@ class BaseSoC(SoCCore):
         #     IOStandard("LVCMOS33")
         # ),
         # in _io_r1_0 litex-boards's platform/gsd_butterstick.py
-        self.submodules.pdmout = pdmout = PDMout(platform, platform.request("pdmout"))
+        self.submodules.pdmout = pdmout = PDMout(platform, platform.request("pdmout"),
+                                                 pipeline=with_pdm_pipeline,
+                                                 stereo=with_pdm_stereo)
+        # Write window for pcm2pdm.stream
+        self.bus.add_slave("pdmout", pdmout.bus, SoCRegion(size=0x1000, cached=False))
 
 # Build --------------------------------------------------------------------------------------------
 
@@ -186,6 +193,8 @@ def main():
     parser.add_argument("--remote-ip",       default="192.168.1.100", help="Remote IP address of TFTP server")
     parser.add_argument("--local-ip",        default="192.168.1.50", help="Local IP address")
     parser.add_argument("--with-spi-flash",  action="store_true",    help="Enable SPI Flash (MMAPed)")
+    parser.add_argument("--pdm-pipeline",    action="store_true",    help="Use pipelined PCM2PDM for higher fmax")
+    parser.add_argument("--pdm-stereo",      action="store_true",    help="Stereo PDM output, left on rising and right on falling edge")
     sdopts = parser.add_mutually_exclusive_group()
     sdopts.add_argument("--with-spi-sdcard", action="store_true", help="Enable SPI-mode SDCard support")
     sdopts.add_argument("--with-sdcard",     action="store_true", help="Enable SDCard support")
@@ -209,6 +218,8 @@ def main():
         local_ip       = args.local_ip,
         remote_ip      = args.remote_ip,
         with_spi_flash = args.with_spi_flash,
+        with_pdm_pipeline = args.pdm_pipeline,
+        with_pdm_stereo = args.pdm_stereo,
         **soc_core_argdict(args))
     if args.with_spi_sdcard:
         soc.add_spi_sdcard()
@@ -2,12 +2,22 @@ import os.path
 __dir__ = os.path.split(os.path.abspath(os.path.realpath(__file__)))[0]
 data_location = os.path.join(__dir__, "verilog")
 
+# only pcm2pdm.v is shipped, make -C pcm2pdm/verilog <target> generates
+# these with amlib
+make_targets = {
+    "pcm2pdm_pipeline.v": "pipeline",
+    "pcm2pdm_stereo.v": "stereo",
+    "pcm2pdm_stereo_pipeline.v": "stereo",
+}
+
 def data_file(f):
     """Get absolute path for file inside pdmout."""
     fn = os.path.join(data_location, f)
     fn = os.path.abspath(fn)
     if not os.path.exists(fn):
-        raise IOError("File {f} doesn't exist in pdmout".format(f))
+        if f in make_targets:
+            raise IOError(f"File {f} doesn't exist in pdmout, run make -C pcm2pdm/verilog {make_targets[f]}")
+        raise IOError(f"File {f} doesn't exist in pdmout")
     return fn
 
 from .pdmout import PDMout
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2022 Kaz Kojima <kkojima@rr.iij4u.or.jp>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+
+from amaranth import *
+from amaranth.hdl.ir import Fragment
+from amaranth.sim import Simulator, Passive
+
+from amlib.test import GatewareTestCase, sync_test_case
+
+from pcm2pdm.dsmodn import FixedPointDeltaSigmaModulator
+from pcm2pdm.pcm2pdm import PCM2PDM
+
+import argparse
+from collections import Counter
+from math import sin, pi
+
+class StageActivity:
+    """ Activity of a stage with an FSM
+
+        The stage is busy while its FSM is out of the reset state. A strobe
+        seen while the stage is busy is counted as an overrun.
+
+        Attributes
+        ----------
+        busy: Counter
+            busy clocks per strobe period
+        slack: Counter
+            idle clocks from the end of the work to the next strobe
+        period: Counter
+            clocks between strobes
+        states: Counter
+            clocks spent in each FSM state
+        overruns: int
+            strobes seen while busy
+        """
+    def __init__(self, name, state, strobe):
+        self.name = name
+        self.state = state
+        self.strobe = strobe
+        self.idle = state.reset
+
+        self.busy = Counter()
+        self.slack = Counter()
+        self.period = Counter()
+        self.states = Counter()
+        self.overruns = 0
+
+        self._last = None
+        self._done = None
+        self._count = 0
+        self._was_busy = False
+
+    def state_name(self, value):
+        decoder = getattr(self.state, "decoder", None)
+        if decoder is None:
+            return str(value)
+        return decoder(value).split("/")[0]
+
+    def sample(self, cycle, state, strobe):
+        busy = state != self.idle
+        self.states[state] += 1
+        if self._was_busy and not busy:
+            self._done = cycle
+        self._was_busy = busy
+        if strobe:
+            if busy:
+                self.overruns += 1
+            if self._last is not None:
+                self.period[cycle - self._last] += 1
+                self.busy[self._count] += 1
+                if not busy:
+                    done = self._last if self._done is None else self._done
+                    self.slack[cycle - done] += 1
+            self._last = cycle
+            self._done = None
+            self._count = 0
+        if busy:
+            self._count += 1
+
+    def utilization(self):
+        clocks = sum(k * v for k, v in self.period.items())
+        if clocks == 0:
+            return 0.
+        return sum(k * v for k, v in self.busy.items()) / clocks
+
+    def report(self):
+        def hist(counter):
+            return " ".join(f"{k}:{counter[k]}" for k in sorted(counter))
+        total = sum(self.states.values())
+        states = " ".join(f"{self.state_name(k)} {v / total:.1%}"
+                          for k, v in sorted(self.states.items()))
+        lines = [
+            f"{self.name}: utilization {self.utilization():.1%} overruns {self.overruns}",
+            f"  period {hist(self.period)}",
+            f"  busy   {hist(self.busy)}",
+            f"  slack  {hist(self.slack)}",
+            f"  states {states}",
+        ]
+        return "\n".join(lines)
+
+class PipelineActivity:
+    """ Per-stage activity profiler for simulation
+
+        Finds the stages in the elaborated design, i.e. fragments having
+        an fsm_state signal and a strobe input, and samples them every
+        clock from a passive process. Simulate self.fragment, not the
+        design itself, so that the sampled signals are the simulated ones.
+        The stages are searched in a prepared copy, which shares the
+        signals but can't be simulated again.
+
+        Parameters
+        ----------
+        design: Elaboratable
+            design to profile
+        strobes: tuple
+            names of the strobe inputs of the stages
+        """
+    def __init__(self, design, strobes=("strobe_in", "enable_in")):
+        self.fragment = Fragment.get(design, platform=None)
+        self.strobes = strobes
+        self.stages = list(self._find_stages(self.fragment.prepare(), "top"))
+
+    def _find_stages(self, fragment, name):
+        state = None
+        strobe = None
+        for signal in fragment.iter_signals():
+            if signal.name == "fsm_state":
+                state = signal
+            elif signal.name in self.strobes:
+                strobe = signal
+        if state is not None and strobe is not None:
+            yield StageActivity(name, state, strobe)
+        for subfragment, subname in fragment.subfragments:
+            yield from self._find_stages(subfragment, f"{name}.{subname}")
+
+    def process(self):
+        yield Passive()
+        cycle = 0
+        while True:
+            for stage in self.stages:
+                stage.sample(cycle, (yield stage.state), (yield stage.strobe))
+            yield
+            cycle += 1
+
+    def simulator(self, period=1e-6, domain="sync"):
+        sim = Simulator(self.fragment)
+        sim.add_clock(period, domain=domain)
+        sim.add_sync_process(self.process, domain=domain)
+        return sim
+
+    def overruns(self):
+        return {stage.name: stage.overruns for stage in self.stages if stage.overruns}
+
+    def report(self):
+        return "\n".join(stage.report() for stage in self.stages)
+
+class PCM2PDMActivityTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = PCM2PDM
+    FRAGMENT_ARGUMENTS = dict(divisor=28, bitwidth=18, fraction_width=18, ds_order=3)
+    STAGES = ["top.fir", "top.hb1", "top.ds"]
+
+    def setUp(self):
+        super().setUp()
+        self.activity = PipelineActivity(self.dut)
+        self.sim = self.activity.simulator(1 / self.SYNC_CLOCK_FREQUENCY)
+
+    @sync_test_case
+    def test_activity(self):
+        dut = self.dut
+        N = 16
+        ftest = 0.1
+        u =[int(0.5*sin(2*pi*i/(4*N*ftest)) * (2**16-7)) for i in range(N)]
+
+        osr = 48
+        divisor = 28
+
+        for i in range(N):
+            yield dut.pcm_data_in.eq(u[i])
+            for _ in range(osr*divisor):
+                yield
+
+        self.assertEqual([s.name for s in self.activity.stages], self.STAGES)
+        self.assertEqual(self.activity.overruns(), {})
+        for stage in self.activity.stages:
+            self.assertGreater(stage.utilization(), 0)
+
+class PCM2PDMHBChainActivityTest(PCM2PDMActivityTest):
+    FRAGMENT_ARGUMENTS = dict(divisor=28, bitwidth=18, fraction_width=18, ds_order=3, hb_chain=3)
+    STAGES = ["top.fir", "top.hb1", "top.hb2", "top.ds"]
+
+class DeltaSigmaOverrunTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = FixedPointDeltaSigmaModulator
+    FRAGMENT_ARGUMENTS = dict(bitwidth=18, fraction_width=18, order=5, osr=48,
+                              mul_loop=True, verbose=False)
+
+    def setUp(self):
+        super().setUp()
+        self.activity = PipelineActivity(self.dut)
+        self.sim = self.activity.simulator(1 / self.SYNC_CLOCK_FREQUENCY)
+
+    @sync_test_case
+    def test_overrun(self):
+        dut = self.dut
+        # strobed faster than the multiplier loop finishes
+        for i in range(64):
+            yield dut.signal_in.eq(1000 * (i % 8))
+            yield dut.strobe_in.eq(1)
+            yield
+            yield dut.strobe_in.eq(0)
+            for _ in range(3):
+                yield
+
+        self.assertEqual([s.name for s in self.activity.stages], ["top"])
+        self.assertGreater(self.activity.overruns().get("top", 0), 0)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PCM2PDM stage activity")
+    parser.add_argument("--samples",  default=32, type=int, help="PCM samples to simulate")
+    parser.add_argument("--divisor",  default=28, type=int, help="clock divisor")
+    parser.add_argument("--bitwidth", default=28, type=int, help="bit width")
+    parser.add_argument("--ds-order", default=5,  type=int, help="delta sigma modulator order")
+    parser.add_argument("--pipeline", action="store_true",  help="pipelined PCM2PDM")
+    parser.add_argument("--hb-chain", default=0,  type=int, help="2x interpolators replacing fir and hb1")
+    args = parser.parse_args()
+
+    dut = PCM2PDM(divisor=args.divisor,
+                  bitwidth=args.bitwidth,
+                  fraction_width=args.bitwidth,
+                  ds_order=args.ds_order,
+                  pipeline=args.pipeline,
+                  hb_chain=args.hb_chain)
+    activity = PipelineActivity(dut)
+    sim = activity.simulator()
+    osr = dut.pre_upsample * dut.post_upsample
+
+    def process():
+        N = args.samples
+        for i in range(N):
+            yield dut.pcm_data_in.eq(int(0.5*sin(2*pi*i/(0.4*N)) * 2**(args.bitwidth-3)))
+            for _ in range(osr*args.divisor):
+                yield
+    sim.add_sync_process(process)
+    sim.run()
+    print(activity.report())
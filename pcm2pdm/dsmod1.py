@@ -16,6 +16,7 @@ class FixedPointDeltaSigmaModulatorOrd1(Elaboratable):
                  bitwidth:       int=18,
                  fraction_width: int=18,
                  osr:            int=64,
+                 pipeline:       bool=False,
                  verbose:        bool=True) -> None:
 
         self.signal_in = Signal(signed(bitwidth))
@@ -24,6 +25,7 @@ class FixedPointDeltaSigmaModulatorOrd1(Elaboratable):
 
         self.bitwidth = bitwidth
         self.fraction_width = fraction_width
+        self.pipeline = pipeline
 
     def elaborate(self, platform) -> Module:
         m = Module()
@@ -46,15 +48,30 @@ class FixedPointDeltaSigmaModulatorOrd1(Elaboratable):
         # dac and s must be in [-2**bw/4, 2**bw/4] to avoid integer overflow
         dac = Signal(signed(bw))
 
-        m.d.comb += s.eq(u - dac)
+        ge = Signal()
+        if self.pipeline:
+            # u, the comparator and strobe are registered together
+            ud = Signal(signed(bw))
+            strobe = Signal()
+            m.d.sync += [
+                ud.eq(u),
+                ge.eq(u + x >= 0),
+                strobe.eq(self.strobe_in)
+            ]
+        else:
+            ud = u
+            strobe = self.strobe_in
+            m.d.comb += ge.eq(u + x >= 0)
+
+        m.d.comb += s.eq(ud - dac)
         m.d.comb += self.signal_out.eq(v)
         m.d.comb += x.eq(xd + dx)
 
-        with m.If(self.strobe_in):
+        with m.If(strobe):
             m.d.sync += xd.eq(x)
             m.d.sync += dx.eq(s)
 
-        with m.If(u + x >= 0):
+        with m.If(ge):
             m.d.comb += dac.eq(2**(bw-2)-1)
             m.d.comb += v.eq(1)
         with m.Else():
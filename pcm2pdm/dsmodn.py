@@ -22,6 +22,7 @@ class FixedPointDeltaSigmaModulator(Elaboratable):
                  hinf:           float=1.5,
                  f0:             float=0.,
                  mul_loop:       bool=False,
+                 pipeline:       bool=False,
                  verbose:        bool=True) -> None:
 
         self.signal_in = Signal(signed(bitwidth))
@@ -44,6 +45,7 @@ class FixedPointDeltaSigmaModulator(Elaboratable):
             self.g = [int(-g * 2**fraction_width)]
 
         self.mul_loop = mul_loop
+        self.pipeline = pipeline
 
         if verbose:
             print(f"deltasigma CRFB order {order} osr {osr} Hinf {hinf} f0 {f0}")
@@ -85,12 +87,35 @@ class FixedPointDeltaSigmaModulator(Elaboratable):
         fb = Array(Signal(signed(bw), name=f"fb{i}") for i in range(n//2))
 
         mul_loop = self.mul_loop
+        pipeline = self.pipeline
         if mul_loop:
             ix = Signal(range(n+1))
             ma = Signal(signed(width))
             mb = Signal(signed(width))
             mz = Signal(signed(width))
-            m.d.comb += mz.eq((ma * mb) >> fbw),
+            if pipeline:
+                m.d.sync += mz.eq((ma * mb) >> fbw)
+            else:
+                m.d.comb += mz.eq((ma * mb) >> fbw),
+
+        if pipeline:
+            # u and the comparator are registered, DACK is delayed one
+            # clock with EVEN_WAIT so that it sees the same values
+            ud = Signal(signed(bw))
+            m.d.sync += ud.eq(u)
+        else:
+            ud = u
+
+        if mul_loop and pipeline:
+            # fb then ws multiplications, issued one per clock and
+            # written back two clocks later
+            nmul = n//2 + n
+            jx = Signal(range(nmul+2))
+            wx = Signal(range(nmul))
+            mul_a = Array([g[i] for i in range(n//2)] + [b[i] for i in range(n)])
+            mul_b = Array([x[2*i+2] for i in range(n//2)] + [s for i in range(n)])
+            mul_z = Array([fb[i] for i in range(n//2)] + [ws[i] for i in range(n)])
+            m.d.comb += wx.eq(jx - 2)
 
         m.d.comb += self.signal_out.eq(v)
 
@@ -108,12 +133,22 @@ class FixedPointDeltaSigmaModulator(Elaboratable):
                 # even: delayed integrator
                 for i in range(n//2+1):
                     m.d.sync += x[2*i].eq(xd[2*i] + dx[2*i])
-                m.next = "DACK"
+                if pipeline:
+                    m.next = "EVEN_WAIT"
+                else:
+                    m.next = "DACK"
+
+            if pipeline:
+                with m.State("EVEN_WAIT"):
+                    m.next = "DACK"
 
             with m.State("DACK"):
                 # assume a[i] = b[i] except for i = n
-                m.d.sync += s.eq(u - dac)
-                if mul_loop:
+                m.d.sync += s.eq(ud - dac)
+                if mul_loop and pipeline:
+                    m.d.sync += jx.eq(0)
+                    m.next = "MULT_PIPE"
+                elif mul_loop:
                     m.d.sync += [
                         ix.eq(0),
                         ma.eq(g[0]),
@@ -123,7 +158,20 @@ class FixedPointDeltaSigmaModulator(Elaboratable):
                 else:
                     m.next = "MULT"
 
-            if mul_loop:
+            if mul_loop and pipeline:
+                with m.State("MULT_PIPE"):
+                    with m.If(jx < nmul):
+                        m.d.sync += [
+                            ma.eq(mul_a[jx]),
+                            mb.eq(mul_b[jx])
+                        ]
+                    with m.If(jx >= 2):
+                        m.d.sync += mul_z[wx].eq(mz)
+                    with m.If(jx == nmul+1):
+                        m.next = "ODD"
+                    m.d.sync += jx.eq(jx+1)
+
+            elif mul_loop:
                 with m.State("MULT_FB"):
                     with m.If(ix == n//2-1):
                         m.d.sync += [
@@ -167,7 +215,13 @@ class FixedPointDeltaSigmaModulator(Elaboratable):
                     m.d.sync += x[2*i+1].eq(xd[2*i+1] + x[2*i] + ws[2*i+1] + fb[i])
                 m.next = "IDLE"
 
-        with m.If(u + x[n-1] >= 0):
+        ge = Signal()
+        if pipeline:
+            m.d.sync += ge.eq(u + x[n-1] >= 0)
+        else:
+            m.d.comb += ge.eq(u + x[n-1] >= 0)
+
+        with m.If(ge):
             m.d.comb += dac.eq(2**(bw-2)-1)
             m.d.comb += v.eq(1)
         with m.Else():
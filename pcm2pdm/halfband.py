@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2022 Kaz Kojima <kkojima@rr.iij4u.or.jp>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+
+from amaranth import *
+
+from amlib.test import GatewareTestCase, sync_test_case
+
+import numpy as np
+from scipy import signal
+from math import sin, pi
+
+class FixedPointPolyphaseInterpolator(Elaboratable):
+    """ 2x interpolator in polyphase form
+
+        The prototype filter h of odd order runs on the zero stuffed
+        input, so an output of phase p is the sum of 2*h[2i+p]*x[n-i].
+        Both phases of an odd order linear phase filter are symmetric,
+        so the symmetric taps are pre-added and the zero taps skipped,
+        and the sums are computed with one multiplier in the clocks
+        between strobes. An odd phase of a single unit tap is just the
+        delayed input.
+
+        Attributes
+        ----------
+        signal_in: Signal(bitwidth), input
+            input sample, read at every other strobe_in starting from
+            the first one after reset
+        signal_out: Signal(bitwidth), output
+            output sample
+        strobe_in: Signal(), input
+            output rate strobe
+
+        Parameters
+        ----------
+        h: list
+            prototype filter of odd order with gain 1 on the pass band
+        bitwidth: int
+            width
+        fraction_width: int
+            fraction width
+        pipeline: bool
+            register the multiplier output
+        """
+    def __init__(self,
+                 h:              list,
+                 bitwidth:       int=18,
+                 fraction_width: int=18,
+                 pipeline:       bool=False) -> None:
+
+        self.signal_in = Signal(signed(bitwidth))
+        self.signal_out = Signal(signed(bitwidth))
+        self.strobe_in = Signal()
+
+        self.bitwidth = bitwidth
+        self.fraction_width = fraction_width
+        assert bitwidth <= fraction_width, f"Bitwidth {bitwidth} must not exceed {fraction_width}"
+        self.pipeline = pipeline
+
+        assert len(h) % 2 == 1, f"Filter order {len(h)} must be odd"
+        # xs[i] = x[n-i]
+        self.length = (len(h) + 1) // 2
+        # (i, j, tap) multiplies x[n-i] + x[n-j], x[n-i] only when i == j
+        self.phases = []
+        for p in range(2):
+            s = 2 * np.asarray(h[p::2])
+            assert np.allclose(s, s[::-1]), f"Phase {p} is not symmetric"
+            taps = [int(round(v * 2**fraction_width)) for v in s[:(len(s)+1)//2]]
+            self.phases.append([(i, len(s)-1-i, c) for i, c in enumerate(taps) if c != 0])
+        odd = self.phases[1]
+        self.passthrough = len(odd) == 1 and odd[0][0] == odd[0][1] and odd[0][2] == 2**fraction_width
+
+        # clocks from a strobe to the output
+        latency = 2 if pipeline else 1
+        self.cycles = max(len(pairs) for pairs in self.phases) + latency + 2
+        # multiplies per input sample
+        self.macs = len(self.phases[0]) + (0 if self.passthrough else len(odd))
+
+    @staticmethod
+    def response(h, samplerate, passband, stopband):
+        """(attenuation, ripple) in dB of h running at 2*samplerate."""
+        w, H = signal.freqz(h, worN=8192, fs=2*samplerate)
+        a = np.abs(H)
+        stop = a[w >= stopband].max()
+        pass_band = a[w <= passband]
+        return -20*np.log10(stop), 20*np.log10(pass_band.max() / pass_band.min())
+
+    def interpolate(self, x):
+        """Bit exact model, the outputs for the inputs x."""
+        fbw = self.fraction_width
+        bw = self.bitwidth
+        xs = [0] * self.length
+        out = []
+        for v in x:
+            xs = [v] + xs[:-1]
+            for pairs in self.phases:
+                acc = 2**(fbw-1) + sum(c * (xs[i] + (xs[j] if i != j else 0)) for i, j, c in pairs)
+                # wrap to bitwidth like the gateware
+                out.append(((acc >> fbw) + 2**(bw-1)) % 2**bw - 2**(bw-1))
+        return out
+
+    def elaborate(self, platform) -> Module:
+        m = Module()
+
+        bw = self.bitwidth
+        fbw = self.fraction_width
+        width = fbw + 2
+        n = max(len(pairs) for pairs in self.phases)
+
+        xs = [Signal(signed(bw), name=f"xs{i}") for i in range(self.length)]
+
+        ma = Signal(signed(width))
+        mb = Signal(signed(bw+1))
+        mz = Signal(signed(width+bw+1))
+        acc = Signal(signed(width+bw+1+n.bit_length()))
+        if self.pipeline:
+            m.d.sync += mz.eq(ma * mb)
+            latency = 2
+        else:
+            m.d.comb += mz.eq(ma * mb)
+            latency = 1
+
+        ix = Signal(range(n+latency+1))
+        # odd output phase
+        phase = Signal()
+
+        with m.FSM(reset="IDLE"):
+            with m.State("IDLE"):
+                with m.If(self.strobe_in):
+                    m.d.sync += [
+                        phase.eq(~phase),
+                        ix.eq(0)
+                    ]
+                    with m.If(phase):
+                        if self.passthrough:
+                            m.d.sync += self.signal_out.eq(xs[self.phases[1][0][0]])
+                        else:
+                            m.next = "MAC"
+                    with m.Else():
+                        m.d.sync += xs[0].eq(self.signal_in)
+                        for i in range(self.length-1):
+                            m.d.sync += xs[i+1].eq(xs[i])
+                        m.next = "MAC"
+
+            with m.State("MAC"):
+                for p, pairs in enumerate(self.phases):
+                    if p == 1 and self.passthrough:
+                        continue
+                    taps = Array(Const(c, signed(width)) for i, j, c in pairs)
+                    operands = Array(xs[i] + xs[j] if i != j else xs[i] for i, j, c in pairs)
+                    # phase is already toggled for the next strobe
+                    with m.If(phase != p):
+                        with m.If(ix < len(pairs)):
+                            m.d.sync += [
+                                ma.eq(taps[ix]),
+                                mb.eq(operands[ix])
+                            ]
+                        with m.If(ix == len(pairs)-1+latency):
+                            m.next = "OUTPUT"
+                with m.If(ix < latency):
+                    # rounding
+                    m.d.sync += acc.eq(2**(fbw-1))
+                with m.Else():
+                    m.d.sync += acc.eq(acc + mz)
+                m.d.sync += ix.eq(ix+1)
+
+            with m.State("OUTPUT"):
+                m.d.sync += self.signal_out.eq(acc >> fbw)
+                m.next = "IDLE"
+
+        return m
+
+class FixedPointFIRInterpolator(FixedPointPolyphaseInterpolator):
+    """ 2x FIR interpolator
+
+        Polyphase form of a linear phase FIR filter of order 4m+1 on
+        the zero stuffed input, designed with the pass band edge and the
+        stop band start. The phases take m+1 and m multiplies of the
+        pre-added symmetric taps.
+
+        Parameters
+        ----------
+        samplerate: int
+            input sampling frequency
+        passband: int
+            pass band edge frequency
+        stopband: int
+            stop band start frequency, the stop band ends at samplerate
+        bitwidth: int
+            width
+        fraction_width: int
+            fraction width
+        attenuation: float
+            stop band attenuation in dB
+        ripple: float
+            pass band ripple in dB
+        filter_order: int
+            filter order 4m+1, the lowest one meeting attenuation and
+            ripple when None
+        pipeline: bool
+            register the multiplier output
+        """
+    def __init__(self,
+                 samplerate:     int=48000,
+                 passband:       int=10000,
+                 stopband:       int=14000,
+                 bitwidth:       int=18,
+                 fraction_width: int=18,
+                 attenuation:    float=60,
+                 ripple:         float=0.05,
+                 filter_order:   int=None,
+                 pipeline:       bool=False,
+                 verbose:        bool=True) -> None:
+
+        assert 0 < passband < stopband < samplerate, \
+            f"Passband {passband} and stopband {stopband} must be in (0, {samplerate})"
+
+        if filter_order is None:
+            for m in range(1, 256):
+                h, stop, passband_ripple = self.design(samplerate, passband, stopband,
+                                                       attenuation, ripple, m)
+                if stop >= attenuation and passband_ripple <= ripple:
+                    break
+            else:
+                assert False, f"No FIR filter meets {attenuation}dB / {ripple}dB"
+        else:
+            assert filter_order % 4 == 1, f"Filter order {filter_order} must be 4m+1"
+            m = filter_order // 4
+            h, stop, passband_ripple = self.design(samplerate, passband, stopband,
+                                                   attenuation, ripple, m)
+
+        self.filter_order = 4*m + 1
+        super().__init__(h, bitwidth=bitwidth, fraction_width=fraction_width, pipeline=pipeline)
+
+        if verbose:
+            print(f"fir interpolator fs {samplerate} order {self.filter_order} "
+                  f"attenuation {stop:.1f}dB ripple {passband_ripple:.4f}dB")
+            print(f"fixed taps: {self.phases}")
+
+    @classmethod
+    def design(cls, samplerate, passband, stopband, attenuation, ripple, m):
+        """Filter h of order 4m+1 and its (attenuation, ripple) in dB."""
+        # weight the bands by the inverse of their allowed deviations
+        dp = (10**(ripple/20) - 1) / (10**(ripple/20) + 1)
+        ds = 10**(-attenuation/20)
+        h = signal.remez(4*m + 1, [0, passband, stopband, samplerate], [1, 0],
+                         weight=[1/dp, 1/ds], fs=2*samplerate)
+        return (h,) + cls.response(h, samplerate, passband, stopband)
+
+class FixedPointHBInterpolator(FixedPointPolyphaseInterpolator):
+    """ 2x half band interpolator
+
+        Polyphase form of a half band filter of order 4k+3 on the zero
+        stuffed input. The odd phase is the delayed input and the even
+        phase is the sum of k+1 products of the pre-added symmetric taps.
+
+        Parameters
+        ----------
+        samplerate: int
+            input sampling frequency
+        passband: int
+            pass band edge frequency, the stop band starts at
+            samplerate - passband
+        bitwidth: int
+            width
+        fraction_width: int
+            fraction width
+        attenuation: float
+            stop band attenuation in dB
+        ripple: float
+            pass band ripple in dB
+        filter_order: int
+            filter order 4k+3, the lowest one meeting attenuation and
+            ripple when None
+        pipeline: bool
+            register the multiplier output
+        """
+    def __init__(self,
+                 samplerate:     int=48000,
+                 passband:       int=10000,
+                 bitwidth:       int=18,
+                 fraction_width: int=18,
+                 attenuation:    float=60,
+                 ripple:         float=0.05,
+                 filter_order:   int=None,
+                 pipeline:       bool=False,
+                 verbose:        bool=True) -> None:
+
+        assert 0 < passband < samplerate / 2, f"Passband {passband} must be in (0, {samplerate / 2})"
+
+        if filter_order is None:
+            for k in range(64):
+                h, stop, passband_ripple = self.design(samplerate, passband, k)
+                if stop >= attenuation and passband_ripple <= ripple:
+                    break
+            else:
+                assert False, f"No half band filter meets {attenuation}dB / {ripple}dB"
+        else:
+            assert filter_order % 4 == 3, f"Filter order {filter_order} must be 4k+3"
+            k = filter_order // 4
+            h, stop, passband_ripple = self.design(samplerate, passband, k)
+
+        self.filter_order = 4*k + 3
+        self.k = k
+        super().__init__(h, bitwidth=bitwidth, fraction_width=fraction_width, pipeline=pipeline)
+
+        if verbose:
+            print(f"half band interpolator fs {samplerate} order {self.filter_order} "
+                  f"attenuation {stop:.1f}dB ripple {passband_ripple:.4f}dB")
+            print(f"fixed taps: {self.phases[0]}")
+
+    @classmethod
+    def design(cls, samplerate, passband, k):
+        """Filter h of order 4k+3 and its (attenuation, ripple) in dB."""
+        # h = z^-(2k+1)/2 + G(z^2)/2, G fits 1 on the pass band. remez
+        # doesn't converge on a very narrow band and a wider one is just
+        # a tighter spec.
+        edge = max(passband / samplerate, 0.1)
+        g = signal.remez(2*k + 2, [0, edge], [1], fs=1)
+        h = np.zeros(4*k + 3)
+        h[0::2] = g / 2
+        h[2*k+1] = 0.5
+        return (h,) + cls.response(h, samplerate, passband, samplerate - passband)
+
+class FixedPointHBInterpolatorTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = FixedPointHBInterpolator
+    FRAGMENT_ARGUMENTS = dict(samplerate=48000, passband=10000, bitwidth=18, fraction_width=18)
+
+    @sync_test_case
+    def test_hb_interpolator(self):
+        dut = self.dut
+        N = 64
+        u =[int(0.5*sin(2*pi*i/16) * (2**17-1)) for i in range(N)]
+        # input at every other strobe, strobe_in period = 16 clk
+        out = []
+        for i in range(2*N):
+            yield dut.signal_in.eq(u[i//2])
+            yield dut.strobe_in.eq(1)
+            yield
+            yield dut.strobe_in.eq(0)
+            for _ in range(15):
+                yield
+            out.append((yield dut.signal_out))
+
+        self.assertEqual(out, dut.interpolate(u))
+
+class FixedPointFIRInterpolatorTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = FixedPointFIRInterpolator
+    FRAGMENT_ARGUMENTS = dict(samplerate=48000, passband=10000, stopband=14000,
+                              bitwidth=18, fraction_width=18, pipeline=True)
+
+    @sync_test_case
+    def test_fir_interpolator(self):
+        dut = self.dut
+        N = 64
+        u =[int(0.5*sin(2*pi*i/16) * (2**17-1)) for i in range(N)]
+        # input at every other strobe, strobe_in period = 48 clk
+        out = []
+        for i in range(2*N):
+            yield dut.signal_in.eq(u[i//2])
+            yield dut.strobe_in.eq(1)
+            yield
+            yield dut.strobe_in.eq(0)
+            for _ in range(47):
+                yield
+            out.append((yield dut.signal_out))
+
+        self.assertEqual(out, dut.interpolate(u))
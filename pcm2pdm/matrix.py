@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2022 Kaz Kojima <kkojima@rr.iij4u.or.jp>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+
+# Test matrix over the modulator and pipeline parameters, run on a
+# process pool and checked against the golden bit streams in golden/.
+#   python3 -m pcm2pdm.matrix                 # run all cases
+#   python3 -m pcm2pdm.matrix -k dsmod5       # cases whose name contains dsmod5
+#   python3 -m pcm2pdm.matrix --update-golden # (re)write the golden files
+# A case without a golden file fails unless --update-golden is given.
+# VCD dumps are written only with --vcd DIR or GENERATE_VCDS=1.
+
+from amaranth.sim import Simulator
+
+from pcm2pdm.dsmod1 import FixedPointDeltaSigmaModulatorOrd1
+from pcm2pdm.dsmodn import FixedPointDeltaSigmaModulator
+from pcm2pdm.pcm2pdm import PCM2PDM
+
+import argparse
+import os
+import sys
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from math import sin, pi
+
+golden_location = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+
+def dsmod_cases():
+    for ds_order, bitwidth, mul_loop, divisor, pipeline in product(
+            [1, 3, 5], [18, 28], [False, True], [16, 28], [False, True]):
+        if ds_order == 1 and mul_loop:
+            continue
+        yield dict(kind="dsmod", ds_order=ds_order, bitwidth=bitwidth,
+                   mul_loop=mul_loop, divisor=divisor, pipeline=pipeline)
+
+def pcm2pdm_cases():
+    """The amlib filters (hb_chain=0) are run with the shipped bitwidth."""
+    for ds_order, bitwidth, hb_chain, divisor, pipeline in product(
+            [1, 3, 5], [18, 28], [0, 3], [16, 20, 28], [False, True]):
+        if hb_chain == 0 and bitwidth != 28:
+            continue
+        yield dict(kind="pcm2pdm", ds_order=ds_order, bitwidth=bitwidth,
+                   hb_chain=hb_chain, divisor=divisor, pipeline=pipeline)
+
+def cases():
+    return list(dsmod_cases()) + list(pcm2pdm_cases())
+
+def case_name(case):
+    name = f"{case['kind']}{case['ds_order']}_b{case['bitwidth']}_d{case['divisor']}"
+    if case.get("mul_loop"):
+        name += "_mul"
+    if case.get("hb_chain"):
+        name += f"_hb{case['hb_chain']}"
+    if case["pipeline"]:
+        name += "_pipe"
+    return name
+
+def golden_name(case):
+    """Cases computing the same bits share a golden file.
+
+    The modulator bits don't depend on the multiplier loop, the divisor
+    and the pipeline, the PCM2PDM bits don't depend on the divisor and
+    the pipeline.
+    """
+    if case["kind"] == "dsmod":
+        return f"dsmod{case['ds_order']}_b{case['bitwidth']}"
+    name = f"pcm2pdm{case['ds_order']}_b{case['bitwidth']}"
+    if case["hb_chain"]:
+        name += f"_hb{case['hb_chain']}"
+    return name
+
+def golden_path(case):
+    return os.path.join(golden_location, golden_name(case) + ".txt")
+
+def read_golden(case):
+    path = golden_path(case)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return "".join(f.read().split())
+
+def write_golden(case, bits):
+    os.makedirs(golden_location, exist_ok=True)
+    with open(golden_path(case), "w") as f:
+        for i in range(0, len(bits), 64):
+            f.write(bits[i:i+64] + "\n")
+
+def simulate(dut, process, vcd=None):
+    sim = Simulator(dut)
+    sim.add_clock(1e-6, domain="sync")
+    sim.add_sync_process(process)
+    if vcd is None:
+        sim.run()
+    else:
+        with sim.write_vcd(vcd):
+            sim.run()
+
+def run_dsmod(case, vcd=None, N=2048):
+    """Modulator bits for a sine, one input sample per strobe."""
+    bw = case["bitwidth"]
+    osr = 48
+    if case["ds_order"] == 1:
+        dut = FixedPointDeltaSigmaModulatorOrd1(bitwidth=bw, fraction_width=bw, osr=osr,
+                                                pipeline=case["pipeline"], verbose=False)
+    else:
+        dut = FixedPointDeltaSigmaModulator(bitwidth=bw, fraction_width=bw,
+                                            order=case["ds_order"], osr=osr,
+                                            mul_loop=case["mul_loop"],
+                                            pipeline=case["pipeline"], verbose=False)
+    # dac is +-2**(bw-2)
+    u = [int(0.5*sin(2*pi*i/(16*osr)) * 2**(bw-2)) for i in range(N)]
+    bits = []
+
+    def process():
+        for i in range(N):
+            yield dut.signal_in.eq(u[i])
+            yield
+            yield dut.strobe_in.eq(1)
+            yield
+            yield dut.strobe_in.eq(0)
+            for _ in range(case["divisor"]-2):
+                yield
+            bits.append((yield dut.signal_out))
+
+    simulate(dut, process, vcd)
+    return "".join(str(b) for b in bits)
+
+def run_pcm2pdm(case, vcd=None, N=64):
+    """PDM bits at the rising edges of the PDM clock for a PCM sine.
+
+    The samples follow pcm_strobe_in and the bits are taken from the first
+    strobe on, so they don't depend on the start phase of the clock divider.
+    """
+    bw = case["bitwidth"]
+    dut = PCM2PDM(divisor=case["divisor"], bitwidth=bw, fraction_width=bw,
+                  ds_order=case["ds_order"], pipeline=case["pipeline"],
+                  hb_chain=case["hb_chain"])
+    osr = dut.pre_upsample * dut.post_upsample
+    u = [int(0.5*sin(2*pi*i/16) * 2**(bw-3)) for i in range(N)]
+    bits = []
+
+    def process():
+        clk = 0
+        i = 0
+        while len(bits) < N*osr:
+            yield
+            if (yield dut.pcm_strobe_in) and i < N:
+                yield dut.pcm_data_in.eq(u[i])
+                i += 1
+            new_clk = (yield dut.pdm_clock_out)
+            if new_clk and not clk and i > 0:
+                bits.append((yield dut.pdm_data_out))
+            clk = new_clk
+
+    simulate(dut, process, vcd)
+    return "".join(str(b) for b in bits)
+
+def run_case(case, vcd_dir=None):
+    """Run a case in a worker, returns (bits, error)."""
+    vcd = None
+    if vcd_dir is not None:
+        vcd = os.path.join(vcd_dir, case_name(case) + ".vcd")
+    try:
+        if case["kind"] == "dsmod":
+            return run_dsmod(case, vcd), None
+        return run_pcm2pdm(case, vcd), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+def run_matrix(cases, jobs=None, vcd_dir=None):
+    """Results of the cases in order, run on a process pool."""
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(run_case, cases, [vcd_dir] * len(cases)))
+
+def default_vcd_dir():
+    return "." if os.getenv("GENERATE_VCDS", "0") not in ("", "0") else None
+
+def first_difference(a, b):
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return i
+    return min(len(a), len(b))
+
+class MatrixTest(unittest.TestCase):
+    def test_matrix(self):
+        matrix = cases()
+        # a case without a golden file fails without being simulated
+        missing = [case for case in matrix if read_golden(case) is None]
+        for case in missing:
+            with self.subTest(case=case_name(case)):
+                self.fail(f"no golden {golden_name(case)}, run python3 -m pcm2pdm.matrix --update-golden")
+
+        matrix = [case for case in matrix if case not in missing]
+        results = run_matrix(matrix, vcd_dir=default_vcd_dir())
+        for case, (bits, error) in zip(matrix, results):
+            with self.subTest(case=case_name(case)):
+                self.assertIsNone(error)
+                golden = read_golden(case)
+                self.assertEqual(len(bits), len(golden))
+                self.assertEqual(bits, golden,
+                                 f"first difference at bit {first_difference(bits, golden)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="PCM2PDM test matrix")
+    parser.add_argument("-k", "--filter",    default="",  help="run cases whose name contains this")
+    parser.add_argument("-j", "--jobs",      default=None, type=int, help="worker processes (default: cpu count)")
+    parser.add_argument("--vcd",             default=default_vcd_dir(), help="write VCD files to this directory")
+    parser.add_argument("--update-golden",   action="store_true", help="write the golden files")
+    parser.add_argument("--list",            action="store_true", help="list the cases")
+    args = parser.parse_args()
+
+    matrix = [case for case in cases() if args.filter in case_name(case)]
+    if args.list:
+        for case in matrix:
+            print(f"{case_name(case):28s} {golden_name(case)}")
+        return 0
+
+    # a case without a golden file fails without being simulated
+    missing = [] if args.update_golden else [case for case in matrix if read_golden(case) is None]
+    for case in missing:
+        print(f"{case_name(case)}: FAIL no golden {golden_name(case)}")
+    failed = len(missing)
+    total = len(matrix)
+    matrix = [case for case in matrix if case not in missing]
+
+    results = run_matrix(matrix, jobs=args.jobs, vcd_dir=args.vcd)
+
+    # golden name -> (case name, bits), None when a case of it failed
+    new_golden = {}
+    for case, (bits, error) in zip(matrix, results):
+        name = case_name(case)
+        if error is not None:
+            print(f"{name}: ERROR {error}")
+            new_golden[golden_name(case)] = None
+            failed += 1
+            continue
+        if args.update_golden:
+            # cases sharing a golden file must agree
+            first = new_golden.setdefault(golden_name(case), (name, bits))
+            if first is not None and first[1] != bits:
+                print(f"{name}: FAIL differs from {first[0]} at bit {first_difference(bits, first[1])}")
+                new_golden[golden_name(case)] = None
+                failed += 1
+            continue
+        golden = read_golden(case)
+        if bits != golden:
+            print(f"{name}: FAIL first difference at bit {first_difference(bits, golden)}")
+            failed += 1
+        else:
+            print(f"{name}: ok")
+
+    if args.update_golden:
+        written = set()
+        for case in matrix:
+            golden = new_golden[golden_name(case)]
+            if golden is not None and golden_name(case) not in written:
+                write_golden(case, golden[1])
+                written.add(golden_name(case))
+        print(f"wrote {len(written)} golden files to {golden_location}")
+
+    print(f"{total} cases, {failed} failed")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,7 +6,8 @@
 from amaranth import *
 from amaranth.lib.fifo import SyncFIFO
 from amaranth.hdl.ast import Rose, Fell
-from amaranth.cli import main
+from amaranth.cli import main_parser, main_runner
+from amaranth.sim import Simulator
 
 from amlib.test import GatewareTestCase, sync_test_case
 from amlib.utils import SimpleClockDivider
@@ -14,9 +15,10 @@ from amlib.dsp import FixedPointFIRFilter, FixedPointHBFilter
 
 from pcm2pdm.dsmod1 import FixedPointDeltaSigmaModulatorOrd1
 from pcm2pdm.dsmodn import FixedPointDeltaSigmaModulator
+from pcm2pdm.halfband import FixedPointFIRInterpolator, FixedPointHBInterpolator
 
 import numpy as np
-from math import sin, pi
+from math import sin, cos, pi
 
 class PCM2PDM(Elaboratable):
     """ PCM to PDM filter pipeline
@@ -56,6 +58,14 @@ class PCM2PDM(Elaboratable):
             half band filter order
         ds_order: int
             deltasigma modulator order
+        pipeline: bool
+            register the stage boundaries and the multiplier for higher fmax
+        hb_chain: int
+            number of 2x interpolators replacing the fir and hb1 filters,
+            0 for none. The first one is a FIR filter with the pass band
+            and stop band of fir_cutoff and fir_weight, the following
+            ones are half band filters passing fir_cutoff[1]. Their
+            orders are chosen automatically.
         """
     def __init__(self,
                  divisor: int=28,
@@ -68,7 +78,9 @@ class PCM2PDM(Elaboratable):
                  fir_order: int=179,
                  fir_cutoff: list=[10000, 14000],
                  fir_weight: list=[0.05, 60],
-                 ds_order: int=5):
+                 ds_order: int=5,
+                 pipeline: bool=False,
+                 hb_chain: int=0):
         self.pdm_clock_out = Signal()
         self.pdm_data_out = Signal()
         self.pcm_strobe_in = Signal()
@@ -87,6 +99,10 @@ class PCM2PDM(Elaboratable):
         self.fir_weight = fir_weight
         self.hb1_order = hb1_order
         self.ds_order = ds_order
+        self.pipeline = pipeline
+        osr = pre_upsample * post_upsample
+        assert osr % 2**hb_chain == 0, f"Oversampling ratio {osr} must be a multiple of {2**hb_chain}"
+        self.hb_chain = hb_chain
 
     def elaborate(self, platform) -> Module:
         m = Module()
@@ -138,6 +154,9 @@ class PCM2PDM(Elaboratable):
                 strobe2.eq(0)
             ]
 
+        if self.hb_chain:
+            return self.elaborate_hb_chain(m, strobe, strobe0, strobe2)
+
         # filters
         fir_fs = self.fs * self.pre_upsample
         fir = FixedPointFIRFilter(samplerate=fir_fs,
@@ -157,24 +176,20 @@ class PCM2PDM(Elaboratable):
                                  verbose=False)
         m.submodules.hb1 = hb1
 
-        if self.ds_order==1:
-            ds = FixedPointDeltaSigmaModulatorOrd1(bitwidth=bw,
-                                                   fraction_width=fbw,
-                                                   osr=osr,
-                                                   verbose=False)
-        else:
-            ds = FixedPointDeltaSigmaModulator(bitwidth=bw,
-                                               fraction_width=fbw,
-                                               order=self.ds_order,
-                                               osr=osr,
-                                               mul_loop=True,
-                                               verbose=False)
+        ds = self.modulator()
         m.submodules.ds = ds
-            
+
+
         with m.If(strobe2):
             m.d.comb += fir.signal_in.eq(self.pcm_data_in)
+        if self.pipeline:
+            # ds registers its input by itself
+            fir_out = Signal(signed(bw))
+            m.d.sync += fir_out.eq(fir.signal_out * self.pre_upsample)
+        else:
+            fir_out = fir.signal_out * self.pre_upsample
         with m.If(strobe1):
-            m.d.comb += hb1.signal_in.eq(fir.signal_out * self.pre_upsample)
+            m.d.comb += hb1.signal_in.eq(fir_out)
         m.d.comb += ds.signal_in.eq(hb1.signal_out * 2)
         #m.d.comb += ds.signal_in.eq(fir.signal_out * self.pre_upsample)
 
@@ -188,6 +203,187 @@ class PCM2PDM(Elaboratable):
 
         return m
 
+    def modulator(self):
+        bw = self.bitwidth
+        fbw = self.fraction_width
+        osr = self.pre_upsample * self.post_upsample
+        if self.ds_order==1:
+            return FixedPointDeltaSigmaModulatorOrd1(bitwidth=bw,
+                                                     fraction_width=fbw,
+                                                     osr=osr,
+                                                     pipeline=self.pipeline,
+                                                     verbose=False)
+        return FixedPointDeltaSigmaModulator(bitwidth=bw,
+                                             fraction_width=fbw,
+                                             order=self.ds_order,
+                                             osr=osr,
+                                             mul_loop=True,
+                                             pipeline=self.pipeline,
+                                             verbose=False)
+
+    def elaborate_hb_chain(self, m, strobe, strobe0, strobe2):
+        osr = self.pre_upsample * self.post_upsample
+        assert isinstance(self.fir_cutoff, list), "Fir_cutoff must be a pass/stop list for hb_chain"
+        passband, stopband = self.fir_cutoff
+        ripple, attenuation = self.fir_weight
+        # the pass band ripples add up, the fir takes most of the budget
+        if self.hb_chain > 1:
+            fir_ripple = ripple * 0.8
+            hb_ripple = ripple * 0.2 / (self.hb_chain - 1)
+        else:
+            fir_ripple = ripple
+
+        # stage i runs at fs * 2**(i+1), reading an input at every other strobe
+        signal = self.pcm_data_in
+        for i in range(self.hb_chain):
+            period = osr >> (i+1)
+            if i == 0:
+                name = "fir"
+                stage = FixedPointFIRInterpolator(samplerate=self.fs,
+                                                  passband=passband,
+                                                  stopband=stopband,
+                                                  bitwidth=self.bitwidth,
+                                                  fraction_width=self.fraction_width,
+                                                  attenuation=attenuation,
+                                                  ripple=fir_ripple,
+                                                  pipeline=self.pipeline,
+                                                  verbose=False)
+            else:
+                # the earlier stages leave nothing above stopband, so a
+                # half band passing it only has to cut the images
+                name = f"hb{i}"
+                stage = FixedPointHBInterpolator(samplerate=self.fs * 2**i,
+                                                 passband=stopband,
+                                                 bitwidth=self.bitwidth,
+                                                 fraction_width=self.fraction_width,
+                                                 attenuation=attenuation,
+                                                 ripple=hb_ripple,
+                                                 pipeline=self.pipeline,
+                                                 verbose=False)
+            assert stage.cycles < period * self.divisor, f"Divisor {self.divisor} is too small for {name}"
+            m.submodules[name] = stage
+
+            count = Signal(range(period), name=f"count_{name}")
+            stage_strobe = Signal(name=f"strobe_{name}")
+            with m.If(strobe):
+                with m.If(count == 0):
+                    m.d.sync += count.eq(period - 1)
+                with m.Else():
+                    m.d.sync += count.eq(count - 1)
+                m.d.sync += stage_strobe.eq(count == 0)
+            with m.Else():
+                m.d.sync += stage_strobe.eq(0)
+
+            m.d.comb += [
+                stage.signal_in.eq(signal),
+                stage.strobe_in.eq(stage_strobe)
+            ]
+            signal = stage.signal_out
+
+        ds = self.modulator()
+        m.submodules.ds = ds
+
+        m.d.comb += [
+            ds.signal_in.eq(signal),
+            self.pcm_strobe_in.eq(strobe2),
+            ds.strobe_in.eq(strobe0),
+            self.pdm_data_out.eq(ds.signal_out)
+        ]
+
+        return m
+
+class PCM2PDMStereo(Elaboratable):
+    """ Stereo PCM to PDM with two pipelines on one data line
+
+        The left bit is driven around the rising edge of pdm_clock_out and
+        the right bit around its falling edge. The data changes a quarter
+        of the PDM clock period after each edge. Each bit is latched from
+        its pipeline at its edge and driven for the same edge of the next
+        PDM clock, so both channels are one PDM clock behind the mono
+        PCM2PDM.
+
+        Attributes
+        ----------
+        pdm_clock_out: Signal(), output
+            PDM clock signal
+        pdm_data_out: Signal(), output
+            PDM data signal, left on rising edge and right on falling edge
+        pcm_strobe_in: Signal(), output
+            PCM clock signal
+        pcm_data_in_l: Signal(16), input
+            left PCM data signal
+        pcm_data_in_r: Signal(16), input
+            right PCM data signal
+
+        Parameters
+        ----------
+        divisor: int
+            clock divisor constant, at least 8
+        other parameters are passed to PCM2PDM
+        """
+    def __init__(self,
+                 divisor: int=28,
+                 bitwidth: int=28,
+                 **kwargs):
+        assert divisor >= 8, f"Divisor {divisor} must be at least 8"
+        self.pdm_clock_out = Signal()
+        self.pdm_data_out = Signal()
+        self.pcm_strobe_in = Signal()
+        self.pcm_data_in_l = Signal(signed(bitwidth))
+        self.pcm_data_in_r = Signal(signed(bitwidth))
+
+        self.divisor = divisor
+        self.bitwidth = bitwidth
+        self.kwargs = kwargs
+
+    def elaborate(self, platform) -> Module:
+        m = Module()
+
+        # both pipelines run in lockstep from reset
+        left = PCM2PDM(divisor=self.divisor, bitwidth=self.bitwidth, **self.kwargs)
+        right = PCM2PDM(divisor=self.divisor, bitwidth=self.bitwidth, **self.kwargs)
+        m.submodules.left = left
+        m.submodules.right = right
+
+        m.d.comb += [
+            left.pcm_data_in.eq(self.pcm_data_in_l),
+            right.pcm_data_in.eq(self.pcm_data_in_r),
+            self.pcm_strobe_in.eq(left.pcm_strobe_in),
+            self.pdm_clock_out.eq(left.pdm_clock_out)
+        ]
+
+        clk = left.pdm_clock_out
+        quarter = self.divisor // 4
+        phase = Signal(range(self.divisor))
+        bit_l = Signal()
+        bit_r = Signal()
+        data = Signal()
+        m.d.comb += self.pdm_data_out.eq(data)
+
+        # the pipeline outputs can change anywhere in the PDM clock period,
+        # so the bits are the ones at the edges
+        with m.If(Rose(clk, domain="sync")):
+            m.d.sync += [
+                bit_l.eq(left.pdm_data_out),
+                phase.eq(1)
+            ]
+        with m.Elif(Fell(clk, domain="sync")):
+            m.d.sync += [
+                bit_r.eq(right.pdm_data_out),
+                phase.eq(1)
+            ]
+        with m.Else():
+            m.d.sync += phase.eq(phase + 1)
+
+        # data is registered, so it changes quarter clocks after the edge
+        with m.If(phase == quarter - 1):
+            with m.If(clk):
+                m.d.sync += data.eq(bit_r)
+            with m.Else():
+                m.d.sync += data.eq(bit_l)
+
+        return m
+
 class PCM2PDMTest(GatewareTestCase):
     FRAGMENT_UNDER_TEST = PCM2PDM
     FRAGMENT_ARGUMENTS = dict(divisor=28, bitwidth=18, fraction_width=18, ds_order=3)
@@ -210,15 +406,144 @@ class PCM2PDMTest(GatewareTestCase):
                 yield
             count = count + 1
 
- 
+class PCM2PDMPipelineTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = PCM2PDM
+    FRAGMENT_ARGUMENTS = dict(divisor=28, bitwidth=18, fraction_width=18, ds_order=3)
+
+    def setUp(self):
+        super().setUp()
+        # the pipelined one runs in lockstep with the same input
+        self.pipelined = PCM2PDM(pipeline=True, **self.FRAGMENT_ARGUMENTS)
+        m = Module()
+        m.submodules.dut = self.dut
+        m.submodules.pipelined = self.pipelined
+        m.d.comb += self.pipelined.pcm_data_in.eq(self.dut.pcm_data_in)
+        self.sim = Simulator(m)
+        self.sim.add_clock(1 / self.SYNC_CLOCK_FREQUENCY, domain="sync")
+
+    @sync_test_case
+    def test_pcm2pdm_pipeline(self):
+        dut = self.dut
+        N = 64
+        u =[int(0.5*sin(2*pi*i/16) * (2**16-7)) for i in range(N)]
+
+        osr = 48
+        divisor = 28
+
+        bits = []
+        pipelined_bits = []
+        clk = 0
+        for i in range(N):
+            yield dut.pcm_data_in.eq(u[i])
+            for _ in range(osr*divisor):
+                yield
+                new_clk = (yield dut.pdm_clock_out)
+                if new_clk != clk:
+                    bits.append((yield dut.pdm_data_out))
+                    pipelined_bits.append((yield self.pipelined.pdm_data_out))
+                clk = new_clk
+
+        self.assertGreater(len(bits), N*osr)
+        self.assertEqual(pipelined_bits, bits)
+
+class PCM2PDMHBChainTest(PCM2PDMTest):
+    FRAGMENT_ARGUMENTS = dict(divisor=28, bitwidth=18, fraction_width=18, ds_order=3, hb_chain=3)
+
+class PCM2PDMHBChainPipelineTest(PCM2PDMPipelineTest):
+    FRAGMENT_ARGUMENTS = dict(divisor=28, bitwidth=18, fraction_width=18, ds_order=3, hb_chain=3)
+
+class PCM2PDMStereoTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = PCM2PDMStereo
+    FRAGMENT_ARGUMENTS = dict(divisor=28, bitwidth=18, fraction_width=18, ds_order=3)
+
+    def setUp(self):
+        super().setUp()
+        # two mono ones run in lockstep with the same inputs
+        self.left = PCM2PDM(**self.FRAGMENT_ARGUMENTS)
+        self.right = PCM2PDM(**self.FRAGMENT_ARGUMENTS)
+        m = Module()
+        m.submodules.dut = self.dut
+        m.submodules.left = self.left
+        m.submodules.right = self.right
+        m.d.comb += [
+            self.left.pcm_data_in.eq(self.dut.pcm_data_in_l),
+            self.right.pcm_data_in.eq(self.dut.pcm_data_in_r)
+        ]
+        self.sim = Simulator(m)
+        self.sim.add_clock(1 / self.SYNC_CLOCK_FREQUENCY, domain="sync")
+
+    @sync_test_case
+    def test_pcm2pdm_stereo(self):
+        dut = self.dut
+        N = 32
+        osr = 48
+        divisor = self.FRAGMENT_ARGUMENTS["divisor"]
+        u_l = [int(0.5*sin(2*pi*i/16) * (2**16-7)) for i in range(N)]
+        u_r = [int(0.5*cos(2*pi*i/8) * (2**16-7)) for i in range(N)]
+
+        bits = []
+        expected = []
+        # clocks from a PDM clock edge to a change of pdm_data_out
+        changes = set()
+        clk = 0
+        data = 0
+        since = None
+        for i in range(N):
+            yield dut.pcm_data_in_l.eq(u_l[i])
+            yield dut.pcm_data_in_r.eq(u_r[i])
+            for _ in range(osr*divisor):
+                yield
+                new_clk = (yield dut.pdm_clock_out)
+                new_data = (yield dut.pdm_data_out)
+                if since is not None:
+                    since += 1
+                    if new_data != data:
+                        changes.add(since)
+                data = new_data
+                if new_clk != clk:
+                    since = 0
+                    bits.append(new_data)
+                    # left on the rising and right on the falling edge
+                    mono = self.left if new_clk else self.right
+                    expected.append((yield mono.pdm_data_out))
+                clk = new_clk
+
+        # one PDM clock behind, the first edges come before the first
+        # bits are latched
+        self.assertEqual(bits[4:], expected[2:-2])
+        self.assertEqual(changes, {divisor // 4})
+
+class PCM2PDMHBChainStereoTest(PCM2PDMStereoTest):
+    FRAGMENT_ARGUMENTS = dict(divisor=20, bitwidth=18, fraction_width=18, ds_order=5,
+                              hb_chain=3, pipeline=True)
+
 if __name__ == "__main__":
+    parser = main_parser()
+    parser.add_argument("--pipeline", action="store_true",
+        help="register the datapath for higher fmax")
+    parser.add_argument("--stereo", action="store_true",
+        help="two channels on one data line")
+    parser.add_argument("--hb-chain", default=0, type=int,
+        help="number of 2x interpolators replacing the fir and hb1 filters")
+    args = parser.parse_args()
 
-    pcm2pdm = PCM2PDM()
+    if args.stereo:
+        pcm2pdm = PCM2PDMStereo(pipeline=args.pipeline, hb_chain=args.hb_chain)
+        name = "PCM2PDMStereo"
+        ports = [
+            pcm2pdm.pcm_data_in_l,
+            pcm2pdm.pcm_data_in_r,
+        ]
+    else:
+        pcm2pdm = PCM2PDM(pipeline=args.pipeline, hb_chain=args.hb_chain)
+        name = "PCM2PDM"
+        ports = [
+            pcm2pdm.pcm_data_in,
+        ]
 
-    ports = [
-        pcm2pdm.pcm_data_in,
+    ports += [
         pcm2pdm.pcm_strobe_in,
         pcm2pdm.pdm_data_out,
         pcm2pdm.pdm_clock_out,
     ]
-    main(pcm2pdm, name="PCM2PDM", ports=ports)
+    main_runner(parser, args, pcm2pdm, name=name, ports=ports)
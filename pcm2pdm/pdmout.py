@@ -9,48 +9,333 @@ from migen import *
 from litex.gen import *
 
 from litex.soc.interconnect import stream
+from litex.soc.interconnect import wishbone
 from litex.soc.interconnect.csr import *
 
 from . import data_file
 
+import unittest
+from unittest import mock
+
 class PDMout(Module, AutoCSR):
-    def __init__(self, platform, pads):
+    def __init__(self, platform, pads, headroom=2, pipeline=False, stereo=False):
+
+        # make -C pcm2pdm/verilog pipeline/stereo generates the others
+        verilog = "pcm2pdm" + ("_stereo" if stereo else "") + ("_pipeline" if pipeline else "") + ".v"
+        platform.add_source(data_file(verilog), "verilog")
 
-        platform.add_source(data_file("pcm2pdm.v"), "verilog")
-    
-        self.submodules.fifo = fifo = stream.SyncFIFO([("data", 16)], 512)
+        # stereo samples are 32-bit words, left in [15:0] and right in [31:16]
+        nch = 2 if stereo else 1
+        dw = 16 * nch
+        self.submodules.fifo = fifo = stream.SyncFIFO([("data", dw)], 512)
 
         # CPU side
         self.ready = CSRStatus(1)
-        self.data = CSRStorage(16)
+        self.level = CSRStatus(len(fifo.level))
+        self.data = CSRStorage(dw)
+        # gain is unsigned Q2.14. 0x3000 (3/4) with 2 bits headroom is
+        # the former fixed 3/16 scaling
+        gain_reset = 0x3000
+        self.gain = CSRStorage(16, reset=gain_reset)
+        self.mute = CSRStorage(1)
+        # gain step per PCM sample, 0 means no ramp
+        self.ramp = CSRStorage(16, reset=0x20)
+
+        # Write window: every word written to the bus is pushed to the fifo,
+        # so an Etherbone burst to consecutive addresses streams samples.
+        # Reads return the fifo level.
+        self.bus = bus = wishbone.Interface()
+        bus_push = Signal()
+        self.comb += [
+            bus_push.eq(bus.cyc & bus.stb & bus.we & ~bus.ack &
+                        ~self.data.re & fifo.sink.ready),
+            bus.dat_r.eq(fifo.level)
+        ]
+        self.sync += [
+            bus.ack.eq(0),
+            If(bus.cyc & bus.stb & ~bus.ack & (~bus.we | bus_push),
+                bus.ack.eq(1)
+            )
+        ]
+
         self.comb += [
             self.ready.status.eq(fifo.sink.ready),
-            fifo.sink.data.eq(self.data.storage),
-            fifo.sink.valid.eq(self.data.re),
+            self.level.status.eq(fifo.level),
+            fifo.sink.data.eq(Mux(self.data.re, self.data.storage, bus.dat_w[:dw])),
+            fifo.sink.valid.eq(self.data.re | bus_push),
             fifo.sink.last.eq(1),
         ]
 
         # PCM2PDM side
         bw = 28
-        self.pcm_data = pcm_data = Signal((bw, True))
+        assert 0 <= headroom < bw - 16, f"Headroom {headroom} must be in [0, {bw-16})"
+        pcm_data = [Signal((bw, True)) for _ in range(nch)]
+        self.pcm_data = pcm_data[0]
+        if stereo:
+            self.pcm_data_r = pcm_data[1]
         self.pcm_strobe_in = pcm_strobe_in = Signal()
         self.pcm_ready = Signal()
         pcm_s16 = Signal((16, True))
+        # channel in the gain stage
+        mul_ch = Signal(max=max(nch, 2))
+
+        # the last samples are scaled again with the current gain while
+        # the fifo is empty, so that mute and gain changes still apply
+        pcm_hold = Signal(dw)
+        # pcm_data is scaled from the fifo head, not from pcm_hold
+        pcm_fresh = Signal()
+        pcm_word = Signal(dw)
 
         self.comb += [
-            fifo.source.ready.eq(pcm_strobe_in),
-            pcm_s16.eq(fifo.source.data),
-            # scale for bit width without overflow
-            # theoritically 1/4 of bw is enough, but computational errors
-            # can make unexpected overflow. 3/16 will be ok
-            self.pcm_data.eq((pcm_s16 + (pcm_s16 << 1)) << (bw-16-4)),
+            pcm_word.eq(Mux(pcm_fresh, fifo.source.data, pcm_hold)),
+            pcm_s16.eq(Array(pcm_word[16*i:16*(i+1)] for i in range(nch))[mul_ch]),
             self.pcm_ready.eq(fifo.source.valid)
         ]
 
-        self.specials += Instance("PCM2PDM",
-                                  i_clk = ClockSignal(),
-                                  i_rst = ResetSignal(),
-                                  i_pcm_data_in = pcm_data,
-                                  o_pdm_data_out = pads.data,
-                                  o_pcm_strobe_in = pcm_strobe_in,
-                                  o_pdm_clock_out = pads.clk)
+        # Gain stage
+        # Theoritically 1/4 of bw is enough, but computational errors
+        # can make unexpected overflow. 3/16, the reset gain 0x3000, is
+        # the maximum for full scale input. headroom bits are reserved and
+        # the result is saturated to [-2**(bw-1-headroom), 2**(bw-1-headroom)),
+        # which full scale input reaches at 0x4000.
+        # The product is computed with a shift-add loop in the idle clocks
+        # between PCM strobes and doesn't consume a multiplier.
+        gain_cur = Signal(16, reset=gain_reset)
+        gain_target = Signal(16)
+        step = self.ramp.storage
+        self.comb += gain_target.eq(Mux(self.mute.storage, 0, self.gain.storage))
+        # ramp once per PCM sample
+        self.sync += If(pcm_strobe_in,
+            If(step == 0,
+                gain_cur.eq(gain_target)
+            ).Elif(gain_cur + step < gain_target,
+                gain_cur.eq(gain_cur + step)
+            ).Elif(gain_cur > gain_target + step,
+                gain_cur.eq(gain_cur - step)
+            ).Else(
+                gain_cur.eq(gain_target)
+            )
+        )
+
+        pw = 16 + 16 + 1
+        mul_x = Signal((pw, True))
+        mul_g = Signal(16)
+        mul_acc = Signal((pw, True))
+        mul_count = Signal(max=16)
+        # pcm_data holds the scaled samples for the next strobe
+        pcm_done = Signal()
+
+        shift = bw - 16 - headroom - 14
+        scaled = Signal((pw + max(shift, 0), True))
+        if shift >= 0:
+            self.comb += scaled.eq(mul_acc << shift)
+        else:
+            self.comb += scaled.eq(mul_acc >> -shift)
+        limit = 2**(bw - 1 - headroom)
+        saturated = Signal((bw, True))
+        self.comb += If(scaled >= limit,
+            saturated.eq(limit - 1)
+        ).Elif(scaled < -limit,
+            saturated.eq(-limit)
+        ).Else(
+            saturated.eq(scaled)
+        )
+
+        self.comb += fifo.source.ready.eq(pcm_strobe_in & pcm_done & pcm_fresh)
+
+        self.submodules.gain_fsm = fsm = FSM(reset_state="IDLE")
+        fsm.act("IDLE",
+            If(pcm_strobe_in & pcm_done,
+                NextValue(pcm_done, 0)
+            ).Elif(~pcm_done | (~pcm_fresh & fifo.source.valid),
+                # start again when the fifo is refilled after an underrun
+                NextValue(pcm_done, 0),
+                NextValue(pcm_fresh, fifo.source.valid),
+                NextValue(mul_ch, 0),
+                NextState("LOAD")
+            )
+        )
+        fsm.act("LOAD",
+            NextValue(mul_x, pcm_s16),
+            NextValue(mul_g, gain_cur),
+            NextValue(mul_acc, 0),
+            NextValue(mul_count, 0),
+            NextState("MULT")
+        )
+        fsm.act("MULT",
+            If(mul_g[0],
+                NextValue(mul_acc, mul_acc + mul_x)
+            ),
+            NextValue(mul_x, mul_x << 1),
+            NextValue(mul_g, mul_g >> 1),
+            NextValue(mul_count, mul_count + 1),
+            If(mul_count == 15,
+                NextState("SCALE")
+            )
+        )
+        fsm.act("SCALE",
+            [If(mul_ch == i, NextValue(pcm_data[i], saturated)) for i in range(nch)],
+            If(mul_ch == nch - 1,
+                If(pcm_fresh,
+                    NextValue(pcm_hold, fifo.source.data)
+                ),
+                NextValue(pcm_done, 1),
+                NextState("IDLE")
+            ).Else(
+                NextValue(mul_ch, mul_ch + 1),
+                NextState("LOAD")
+            )
+        )
+
+        # Stereo puts left on the rising and right on the falling edge
+        # of pads.clk
+        if stereo:
+            self.specials += Instance("PCM2PDMStereo",
+                                      i_clk = ClockSignal(),
+                                      i_rst = ResetSignal(),
+                                      i_pcm_data_in_l = pcm_data[0],
+                                      i_pcm_data_in_r = pcm_data[1],
+                                      o_pdm_data_out = pads.data,
+                                      o_pcm_strobe_in = pcm_strobe_in,
+                                      o_pdm_clock_out = pads.clk)
+        else:
+            self.specials += Instance("PCM2PDM",
+                                      i_clk = ClockSignal(),
+                                      i_rst = ResetSignal(),
+                                      i_pcm_data_in = pcm_data[0],
+                                      o_pdm_data_out = pads.data,
+                                      o_pcm_strobe_in = pcm_strobe_in,
+                                      o_pdm_clock_out = pads.clk)
+
+class PDMoutGainTest(unittest.TestCase):
+    """Gain stage of PDMout without the PCM2PDM instance."""
+    class Platform:
+        def add_source(self, *args):
+            pass
+
+    def setUp(self):
+        self.dut = self.pdmout()
+
+    def pdmout(self, **kwargs):
+        # the generated verilog isn't needed without the instance
+        with mock.patch(f"{__name__}.data_file"):
+            dut = PDMout(self.Platform(), Record([("data", 1), ("clk", 1)]), **kwargs)
+        # pcm_strobe_in is driven by the test instead
+        dut._fragment.specials = {s for s in dut._fragment.specials
+                                  if not isinstance(s, Instance)}
+        return dut
+
+    def push(self, value):
+        yield self.dut.data.storage.eq(value & (2**len(self.dut.data.storage) - 1))
+        yield self.dut.data.re.eq(1)
+        yield
+        yield self.dut.data.re.eq(0)
+
+    def strobe(self):
+        """Value consumed at the next PCM strobe."""
+        for _ in range(96):
+            yield
+        value = (yield self.dut.pcm_data)
+        if hasattr(self.dut, "pcm_data_r"):
+            value = (value, (yield self.dut.pcm_data_r))
+        yield self.dut.pcm_strobe_in.eq(1)
+        yield
+        yield self.dut.pcm_strobe_in.eq(0)
+        return value
+
+    def test_reset_gain(self):
+        xs = [1000, -32768, 32767, -1, 5, 0]
+        out = []
+        def gen():
+            for x in xs:
+                yield from self.push(x)
+            for _ in xs:
+                out.append((yield from self.strobe()))
+        run_simulation(self.dut, gen())
+        # the former fixed 3/16 scaling
+        self.assertEqual(out, [(x*3) << 8 for x in xs])
+
+    def test_saturation(self):
+        limit = 2**(28 - 1 - 2)
+        out = []
+        def gen():
+            yield self.dut.gain.storage.eq(0xffff)
+            yield self.dut.ramp.storage.eq(0)
+            # the ramp follows at the first strobe
+            yield from self.push(0)
+            yield from self.strobe()
+            for x in [32767, -32768, 1000]:
+                yield from self.push(x)
+            for _ in range(3):
+                out.append((yield from self.strobe()))
+        run_simulation(self.dut, gen())
+        self.assertEqual(out, [limit - 1, -limit, (1000*0xffff) >> 4])
+
+    def test_mute_ramp(self):
+        x = 0x4000
+        out = []
+        def gen():
+            yield self.dut.ramp.storage.eq(0x800)
+            yield self.dut.mute.storage.eq(1)
+            for _ in range(9):
+                yield from self.push(x)
+                out.append((yield from self.strobe()))
+        run_simulation(self.dut, gen())
+        # x * gain >> 4, the gain at the sample
+        gains = [v // (x >> 4) for v in out]
+        self.assertEqual(gains, [0x3000, 0x2800, 0x2000, 0x1800, 0x1000, 0x800, 0, 0, 0])
+
+    def test_underrun(self):
+        out = []
+        def gen():
+            for x in [100, -200]:
+                yield from self.push(x)
+            for _ in range(5):
+                out.append((yield from self.strobe()))
+            out.append((yield self.dut.fifo.level))
+        run_simulation(self.dut, gen())
+        # the last sample is held while the fifo is empty
+        self.assertEqual(out, [100*768, -200*768, -200*768, -200*768, -200*768, 0])
+
+    def test_underrun_mute(self):
+        x = 0x4000
+        out = []
+        def gen():
+            yield self.dut.ramp.storage.eq(0x800)
+            yield from self.push(x)
+            out.append((yield from self.strobe()))
+            # the stream stalls, then it is muted
+            yield self.dut.mute.storage.eq(1)
+            for _ in range(8):
+                out.append((yield from self.strobe()))
+        run_simulation(self.dut, gen())
+        # the held sample follows the gain down to silence
+        gains = [v // (x >> 4) for v in out]
+        self.assertEqual(gains, [0x3000, 0x3000, 0x2800, 0x2000, 0x1800, 0x1000, 0x800, 0, 0])
+
+    def test_underrun_refill(self):
+        out = []
+        def gen():
+            yield from self.push(100)
+            out.append((yield from self.strobe()))
+            out.append((yield from self.strobe()))
+            # a sample arriving after the held one was scaled isn't skipped
+            yield from self.push(-200)
+            for _ in range(2):
+                out.append((yield from self.strobe()))
+            out.append((yield self.dut.fifo.level))
+        run_simulation(self.dut, gen())
+        self.assertEqual(out, [100*768, 100*768, -200*768, -200*768, 0])
+
+    def test_stereo(self):
+        self.dut = self.pdmout(stereo=True)
+        xs = [(1000, -1000), (-32768, 32767), (5, 0)]
+        out = []
+        def gen():
+            for l, r in xs:
+                yield from self.push(((r & 0xffff) << 16) | (l & 0xffff))
+            for _ in range(len(xs) + 1):
+                out.append((yield from self.strobe()))
+        run_simulation(self.dut, gen())
+        # left in [15:0], right in [31:16], the last pair held
+        self.assertEqual(out, [((l*3) << 8, (r*3) << 8) for l, r in xs + xs[-1:]])
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+#
+# This file is part of PCM2PDM.
+#
+# Copyright (c) 2022 Kaz Kojima <kkojima@rr.iij4u.or.jp>
+# SPDX-License-Identifier: BSD-2-Clause
+
+# Stream 16-bit raw PCM to PDMout over Etherbone:
+# sox music.wav -t raw -r 48000 -b 16 -c 1 -e signed - | \
+#   python3 -m pcm2pdm.stream --csr-csv csr.csv --host 192.168.1.50 -
+# Use -c 2 and --stereo for a stereo PDMout.
+#
+# litex_server forwards one request at a time, so this talks Etherbone/UDP
+# to the board directly like litex_server --udp does. Don't run both at
+# once, they share the local UDP port.
+
+import argparse
+import asyncio
+import csv
+import struct
+import sys
+import unittest
+from collections import deque
+
+from litex.tools.remote.etherbone import EtherbonePacket, EtherboneRecord
+from litex.tools.remote.etherbone import EtherboneReads, EtherboneWrites
+
+def read_csr_csv(csr_csv):
+    """Get (level CSR address, write window address) from csr.csv."""
+    level_addr = None
+    window_addr = None
+    with open(csr_csv) as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith("#"):
+                continue
+            if row[0] == "csr_register" and row[1] == "pdmout_level":
+                level_addr = int(row[2], 0)
+            if row[0] == "memory_region" and row[1] == "pdmout":
+                window_addr = int(row[2], 0)
+    if level_addr is None or window_addr is None:
+        raise ValueError(f"pdmout_level or pdmout region not found in {csr_csv}")
+    return level_addr, window_addr
+
+def encode_request(window_addr, datas, tag, level_addr):
+    """Etherbone packet writing datas to the window and reading the level back to tag."""
+    record = EtherboneRecord()
+    if datas:
+        record.writes = EtherboneWrites(base_addr=window_addr, datas=datas)
+    record.reads = EtherboneReads(base_ret_addr=tag, addrs=[level_addr])
+    packet = EtherbonePacket()
+    packet.records = [record]
+    packet.encode()
+    return packet.bytes
+
+class PDMStreamer(asyncio.DatagramProtocol):
+    """ Etherbone client pacing PCM samples to PDMout
+
+        Each request writes a burst of samples to the pdmout write window
+        and reads pdmout_level back. Up to inflight requests are kept on
+        the wire and the free space of the fifo is estimated from the last
+        level reply minus the samples sent after that request.
+
+        Parameters
+        ----------
+        level_addr: int
+            pdmout_level CSR address
+        window_addr: int
+            pdmout write window address
+        fifo_depth: int
+            PDMout fifo depth
+        burst: int
+            max samples per request, Etherbone allows 255
+        inflight: int
+            max requests in flight
+        rate: int
+            sample rate, used to wait while the fifo is full
+        timeout: float
+            reply timeout in seconds
+        """
+    def __init__(self,
+                 level_addr: int,
+                 window_addr: int,
+                 fifo_depth: int=512,
+                 burst: int=128,
+                 inflight: int=4,
+                 rate: int=48000,
+                 timeout: float=0.5):
+        assert 0 < burst <= 255, f"Burst {burst} must be in [1, 255]"
+        assert burst <= fifo_depth, f"Burst {burst} must not exceed {fifo_depth}"
+        self.level_addr = level_addr
+        self.window_addr = window_addr
+        self.fifo_depth = fifo_depth
+        self.burst = burst
+        self.inflight = inflight
+        self.rate = rate
+        self.timeout = timeout
+
+        self.transport = None
+        self.pending = {}
+        self.tag = 0
+        # samples sent, samples covered by the last level reply
+        self.sent = 0
+        self.acked = 0
+        self.level = None
+        self.lost = 0
+        self.tasks = set()
+        self.changed = asyncio.Event()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        packet = EtherbonePacket(init=data)
+        packet.decode()
+        for record in packet.records:
+            if record.writes is None:
+                continue
+            future = self.pending.pop(record.writes.base_addr, None)
+            if future is not None and not future.done():
+                future.set_result(record.writes.get_datas()[0])
+
+    def free(self):
+        if self.level is None:
+            return 0
+        return self.fifo_depth - self.level - (self.sent - self.acked)
+
+    async def reply(self, tag, future, sent):
+        try:
+            level = await asyncio.wait_for(future, self.timeout)
+            if sent >= self.acked:
+                self.acked = sent
+                self.level = level
+        except asyncio.TimeoutError:
+            # the samples may or may not have reached the fifo
+            self.pending.pop(tag, None)
+            self.lost += 1
+
+    def done(self, task):
+        self.tasks.discard(task)
+        self.changed.set()
+
+    def spawn(self, samples):
+        tag = self.tag << 2
+        self.tag = (self.tag + 1) & 0xffff
+        future = asyncio.get_running_loop().create_future()
+        self.pending[tag] = future
+        self.transport.sendto(encode_request(self.window_addr, samples,
+                                             tag, self.level_addr))
+        self.sent += len(samples)
+        task = asyncio.ensure_future(self.reply(tag, future, self.sent))
+        self.tasks.add(task)
+        task.add_done_callback(self.done)
+
+    async def write(self, samples):
+        """Send window words, waiting for the fifo room."""
+        for i in range(0, len(samples), self.burst):
+            chunk = samples[i:i+self.burst]
+            while True:
+                # clear before testing, every state change sets it again
+                self.changed.clear()
+                if len(self.tasks) < self.inflight and self.free() >= len(chunk):
+                    break
+                if not self.tasks:
+                    # nothing in flight, poll the level after the fifo drains
+                    if self.level is not None:
+                        await asyncio.sleep((len(chunk) - self.free()) / self.rate)
+                    self.spawn([])
+                await self.changed.wait()
+            self.spawn(chunk)
+
+    async def flush(self):
+        while True:
+            self.changed.clear()
+            if not self.tasks:
+                break
+            await self.changed.wait()
+
+def pack_samples(data, stereo=False):
+    """Window words of 16-bit PCM, left in [15:0] and right in [31:16] for stereo."""
+    n = len(data) // 2
+    samples = struct.unpack(f"<{n}h", data[:2*n])
+    if not stereo:
+        return [s & 0xffff for s in samples]
+    return [(l & 0xffff) | ((r & 0xffff) << 16)
+            for l, r in zip(samples[0::2], samples[1::2])]
+
+async def stream_file(f, host, port, local_port, stereo=False, **kwargs):
+    loop = asyncio.get_running_loop()
+    transport, streamer = await loop.create_datagram_endpoint(
+        lambda: PDMStreamer(**kwargs),
+        local_addr=("0.0.0.0", local_port),
+        remote_addr=(host, port))
+    try:
+        nbytes = streamer.burst * (4 if stereo else 2) * streamer.inflight
+        while True:
+            data = await loop.run_in_executor(None, f.read, nbytes)
+            if not data:
+                break
+            await streamer.write(pack_samples(data, stereo))
+        await streamer.flush()
+    finally:
+        transport.close()
+    return streamer
+
+class PDMoutStandIn(asyncio.DatagramProtocol):
+    """ Stand-in for the board answering Etherbone like PDMout
+
+        Writes to the window are pushed to a fifo drained at rate,
+        reads of the level address return the fifo level.
+        """
+    def __init__(self, level_addr, window_addr, fifo_depth=512, rate=48000):
+        self.level_addr = level_addr
+        self.window_addr = window_addr
+        self.fifo = deque()
+        self.fifo_depth = fifo_depth
+        self.rate = rate
+        self.received = []
+        self.overflow = 0
+        self.underrun = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        packet = EtherbonePacket(init=data)
+        packet.decode()
+        record = packet.records[0]
+        if record.writes is not None:
+            assert record.writes.base_addr == self.window_addr
+            for data in record.writes.get_datas():
+                if len(self.fifo) < self.fifo_depth:
+                    self.fifo.append(data)
+                else:
+                    self.overflow += 1
+        if record.reads is not None:
+            datas = [len(self.fifo) if a == self.level_addr else 0
+                     for a in record.reads.get_addrs()]
+            # EtherboneReads.decode() doesn't keep base_ret_addr
+            base_ret_addr = struct.unpack(">I", bytes(record.reads.bytes[:4]))[0]
+            reply = EtherboneRecord()
+            reply.writes = EtherboneWrites(base_addr=base_ret_addr, datas=datas)
+            packet = EtherbonePacket()
+            packet.records = [reply]
+            packet.encode()
+            self.transport.sendto(packet.bytes, addr)
+
+    async def drain(self, n):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for i in range(n):
+            await asyncio.sleep(max(0, start + i / self.rate - loop.time()))
+            if self.fifo:
+                self.received.append(self.fifo.popleft())
+            else:
+                self.underrun += 1
+
+class PDMStreamTest(unittest.TestCase):
+    LEVEL_ADDR = 0xf0003004
+    WINDOW_ADDR = 0x90000000
+    RATE = 16000
+
+    def test_stream(self):
+        N = 2048
+        samples = [(i * 37) % 65536 for i in range(N)]
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            transport, board = await loop.create_datagram_endpoint(
+                lambda: PDMoutStandIn(self.LEVEL_ADDR, self.WINDOW_ADDR, rate=self.RATE),
+                local_addr=("127.0.0.1", 0))
+            port = transport.get_extra_info("sockname")[1]
+            client, streamer = await loop.create_datagram_endpoint(
+                lambda: PDMStreamer(self.LEVEL_ADDR, self.WINDOW_ADDR, rate=self.RATE),
+                local_addr=("127.0.0.1", 0),
+                remote_addr=("127.0.0.1", port))
+            # fill the fifo before draining starts
+            await streamer.write(samples[:512])
+            await streamer.flush()
+            drain = asyncio.ensure_future(board.drain(N))
+            await streamer.write(samples[512:])
+            await streamer.flush()
+            await drain
+            client.close()
+            transport.close()
+            return board, streamer
+
+        board, streamer = asyncio.run(run())
+        self.assertEqual(board.overflow, 0)
+        self.assertEqual(board.underrun, 0)
+        self.assertEqual(streamer.lost, 0)
+        self.assertEqual(board.received, samples)
+
+    def test_pack_samples(self):
+        data = struct.pack("<4h", 1, -1, -32768, 32767)
+        self.assertEqual(pack_samples(data), [0x0001, 0xffff, 0x8000, 0x7fff])
+        self.assertEqual(pack_samples(data, stereo=True), [0xffff0001, 0x7fff8000])
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream raw PCM to PDMout over Etherbone")
+    parser.add_argument("--csr-csv",    default="csr.csv",      help="CSR configuration file")
+    parser.add_argument("--host",       default="192.168.1.50", help="Etherbone IP address")
+    parser.add_argument("--port",       default=1234, type=int, help="Etherbone UDP port")
+    parser.add_argument("--local-port", default=1234, type=int, help="Local UDP port, the board replies to 1234")
+    parser.add_argument("--burst",      default=128,  type=int, help="Samples per request (max 255)")
+    parser.add_argument("--inflight",   default=4,    type=int, help="Requests in flight")
+    parser.add_argument("--rate",       default=48000, type=int, help="Sample rate")
+    parser.add_argument("--stereo",     action="store_true",    help="Interleaved stereo input for a stereo PDMout")
+    parser.add_argument("file",         help="16-bit little endian raw PCM file, - for stdin")
+    args = parser.parse_args()
+
+    level_addr, window_addr = read_csr_csv(args.csr_csv)
+    f = sys.stdin.buffer if args.file == "-" else open(args.file, "rb")
+    streamer = asyncio.run(stream_file(f, args.host, args.port, args.local_port,
+                                       level_addr=level_addr,
+                                       window_addr=window_addr,
+                                       stereo=args.stereo,
+                                       burst=args.burst,
+                                       inflight=args.inflight,
+                                       rate=args.rate))
+    if streamer.lost:
+        print(f"{streamer.lost} requests timed out", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
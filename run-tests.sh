@@ -1,5 +1,18 @@
 #!/bin/bash
 
-export GENERATE_VCDS=1
+# VCD dumps are opt-in: GENERATE_VCDS=1 ./run-tests.sh
 
 python3 -m unittest pcm2pdm.pcm2pdm.PCM2PDMTest
+python3 -m unittest pcm2pdm.pcm2pdm.PCM2PDMPipelineTest
+python3 -m unittest pcm2pdm.pcm2pdm.PCM2PDMStereoTest
+python3 -m unittest pcm2pdm.pcm2pdm.PCM2PDMHBChainStereoTest
+python3 -m unittest pcm2pdm.pcm2pdm.PCM2PDMHBChainTest
+python3 -m unittest pcm2pdm.pcm2pdm.PCM2PDMHBChainPipelineTest
+python3 -m unittest pcm2pdm.halfband.FixedPointHBInterpolatorTest
+python3 -m unittest pcm2pdm.halfband.FixedPointFIRInterpolatorTest
+python3 -m unittest pcm2pdm.pdmout.PDMoutGainTest
+python3 -m unittest pcm2pdm.stream.PDMStreamTest
+python3 -m unittest pcm2pdm.activity.PCM2PDMActivityTest
+python3 -m unittest pcm2pdm.activity.PCM2PDMHBChainActivityTest
+python3 -m unittest pcm2pdm.activity.DeltaSigmaOverrunTest
+python3 -m unittest pcm2pdm.matrix.MatrixTest